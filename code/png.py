@@ -222,6 +222,14 @@ def adam7_generate(width, height):
         yield ((xstart, y, xstep) for y in range(ystart, height, ystep))
 
 
+# Decoders for the 16-bit colour values of
+# the ``bKGD`` and ``tRNS`` chunks (used by the Reader),
+# keyed by the number of colour planes.
+colour_struct = {
+    1: struct.Struct("!1H"),
+    3: struct.Struct("!3H"),
+}
+
 # Models the 'pHYs' chunk (used by the Reader)
 Resolution = collections.namedtuple('_Resolution', 'x y unit_is_meter')
 
@@ -751,7 +759,7 @@ class Writer:
                     write_chunk(outfile, b'IDAT', compressed)
                 data = bytearray()
 
-        compressed = compressor.compress(bytes(data))
+        compressed = compressor.compress(data)
         flushed = compressor.flush()
         if len(compressed) or len(flushed):
             write_chunk(outfile, b'IDAT', compressed + flushed)
@@ -848,6 +856,10 @@ class Writer:
                 self.array_scanlines_interlace(pixels)
             )
         else:
+            if isinstance(pixels, (bytes, bytearray)):
+                # Rows sliced from a memoryview share the buffer,
+                # rather than each being copied out of it.
+                pixels = memoryview(pixels)
             return self.write_passes(
                 outfile,
                 self.array_scanlines(pixels)
@@ -917,8 +929,7 @@ def write_chunk(outfile, tag, data=b''):
 
     data = bytes(data)
     # http://www.w3.org/TR/PNG/#5Chunk-layout
-    outfile.write(struct.pack("!I", len(data)))
-    outfile.write(tag)
+    outfile.write(struct.pack("!I", len(data)) + tag)
     outfile.write(data)
     checksum = zlib.crc32(tag)
     checksum = zlib.crc32(data, checksum)
@@ -977,28 +988,32 @@ def pack_rows(rows, bitdepth):
 
     # samples per byte
     spb = int(8 / bitdepth)
-
-    def make_byte(block):
-        """Take a block of (2, 4, or 8) values,
-        and pack them into a single byte.
-        """
-
-        res = 0
-        for v in block:
-            res = (res << bitdepth) + v
-        return res
+    # The sample values that fit in bitdepth bits.
+    valid = bytes(range(1 << bitdepth))
 
     for row in rows:
         a = bytearray(row)
         # Adding padding bytes so we can group into a whole
         # number of spb-tuples.
-        n = float(len(a))
-        extra = math.ceil(n / spb) * spb - n
-        a.extend([0] * int(extra))
-        # Pack into bytes.
-        # Each block is the samples for one byte.
-        blocks = group(a, spb)
-        yield bytearray(make_byte(block) for block in blocks)
+        a.extend(bytes(-len(a) % spb))
+        # A sample with bits above bitdepth would spill into
+        # its neighbours when the slices are combined below.
+        # Deleting every in-range value leaves any that are not.
+        bad = a.translate(None, valid)
+        if bad:
+            raise ValueError(
+                "sample value %d does not fit in bitdepth %d"
+                % (bad[0], bitdepth))
+        # Pack into bytes, a whole row at a time.
+        # The k-th sample of every byte is taken with a single
+        # slice, and the row of them treated as one big integer;
+        # shifted into position, the slices can be OR'd together
+        # because their bits do not overlap.
+        packed = 0
+        for k in range(spb):
+            packed |= (int.from_bytes(a[k::spb], 'big')
+                       << (bitdepth * (spb - 1 - k)))
+        yield bytearray(packed.to_bytes(len(a) // spb, 'big'))
 
 
 def unpack_rows(rows):
@@ -1006,8 +1021,17 @@ def unpack_rows(rows):
     to being a sequence of bytes.
     """
     for row in rows:
+        if isinstance(row, array) and row.typecode == 'H':
+            # Rows from the Reader, and from interlacing, are
+            # already arrays; byteswapping a copy avoids unpacking
+            # every value into the arguments of struct.pack.
+            row = array('H', row)
+            if sys.byteorder == 'little':
+                row.byteswap()
+            yield row.tobytes()
+            continue
         fmt = '!%dH' % len(row)
-        yield bytearray(struct.pack(fmt, *row))
+        yield struct.pack(fmt, *row)
 
 
 def make_palette_chunks(palette):
@@ -1465,20 +1489,22 @@ class Reader:
         # byte is used instead.
         fu = max(1, self.psize)
 
-        # For the first line of a pass, synthesize a dummy previous
-        # line.  An alternative approach would be to observe that on the
-        # first line 'up' is the same as 'null', 'paeth' is the same
-        # as 'sub', with only 'average' requiring any special case.
+        # For the first line of a pass the previous line is
+        # implicitly all zeros.  On that line
+        # 'up' is the same as 'null', and
+        # 'paeth' is the same as 'sub' (which is much quicker);
+        # only 'average' needs a dummy previous line.
         if not previous:
-            previous = bytearray([0] * len(scanline))
+            if filter_type == 2:
+                return result
+            if filter_type == 4:
+                filter_type = 1
+            if filter_type == 3:
+                previous = bytearray(len(scanline))
 
         # Call appropriate filter algorithm.  Note that 0 has already
         # been dealt with.
-        fn = (None,
-              undo_filter_sub,
-              undo_filter_up,
-              undo_filter_average,
-              undo_filter_paeth)[filter_type]
+        fn = undo_filters[filter_type]
         fn(fu, scanline, previous, result)
         return result
 
@@ -1488,8 +1514,15 @@ class Reader:
         Return a single array of values.
         """
 
+        # Bind the attributes and methods used for every scanline.
+        width = self.width
+        planes = self.planes
+        bits_per_pixel = self.bitdepth * planes
+        undo_filter = self.undo_filter
+        bytes_to_values = self._bytes_to_values
+
         # Values per row (of the target image)
-        vpr = self.width * self.planes
+        vpr = width * planes
 
         # Values per image
         vpi = vpr * self.height
@@ -1497,40 +1530,40 @@ class Reader:
         # (well, not quite), so the entire output array must be in memory.
         # Make a result array, and make it big enough.
         if self.bitdepth > 8:
-            a = array('H', [0] * vpi)
+            a = array('H', [0]) * vpi
         else:
-            a = bytearray([0] * vpi)
+            a = bytearray(vpi)
         source_offset = 0
 
-        for lines in adam7_generate(self.width, self.height):
+        for lines in adam7_generate(width, self.height):
             # The previous (reconstructed) scanline.
             # `None` at the beginning of a pass
             # to indicate that there is no previous line.
             recon = None
             for x, y, xstep in lines:
                 # Pixels per row (reduced pass image)
-                ppr = int(math.ceil((self.width - x) / float(xstep)))
+                ppr = int(math.ceil((width - x) / float(xstep)))
                 # Row size in bytes for this pass.
-                row_size = int(math.ceil(self.psize * ppr))
+                row_size = (ppr * bits_per_pixel + 7) // 8
 
                 filter_type = raw[source_offset]
                 source_offset += 1
                 scanline = raw[source_offset: source_offset + row_size]
                 source_offset += row_size
-                recon = self.undo_filter(filter_type, scanline, recon)
+                recon = undo_filter(filter_type, scanline, recon)
                 # Convert so that there is one element per pixel value
-                flat = self._bytes_to_values(recon, width=ppr)
+                flat = bytes_to_values(recon, width=ppr)
                 if xstep == 1:
                     assert x == 0
                     offset = y * vpr
                     a[offset: offset + vpr] = flat
                 else:
-                    offset = y * vpr + x * self.planes
+                    offset = y * vpr + x * planes
                     end_offset = (y + 1) * vpr
-                    skip = self.planes * xstep
-                    for i in range(self.planes):
+                    skip = planes * xstep
+                    for i in range(planes):
                         a[offset + i: end_offset: skip] = \
-                            flat[i:: self.planes]
+                            flat[i:: planes]
 
         return a
 
@@ -1576,22 +1609,61 @@ class Reader:
         Assumes input is straightlaced.
         `byte_blocks` should be an iterable that yields the raw bytes
         in blocks of arbitrary size.
+
+        Two row buffers are used, alternately,
+        so a row that is yielded is overwritten
+        when the row after next is decoded;
+        callers that keep rows must copy them.
         """
 
         # length of row, in bytes
         rb = self.row_bytes
+        # length of row, including its filter type byte
+        stride = rb + 1
+        undo_filter = self.undo_filter
+        # Accumulates a row that spans more than one block.
         a = bytearray()
         # The previous (reconstructed) scanline.
         # None indicates first line of image.
         recon = None
+        # The buffer that the next scanline is decoded into;
+        # it is swapped with `spare` after each row,
+        # so that the previous scanline is not overwritten.
+        scanline = bytearray(rb)
+        spare = bytearray(rb)
         for some_bytes in byte_blocks:
-            a.extend(some_bytes)
-            while len(a) >= rb + 1:
-                filter_type = a[0]
-                scanline = a[1: rb + 1]
-                del a[: rb + 1]
-                recon = self.undo_filter(filter_type, scanline, recon)
+            view = memoryview(some_bytes)
+            offset = 0
+            if a:
+                # Complete the row started in an earlier block.
+                offset = stride - len(a)
+                a.extend(view[:offset])
+                if len(a) < stride:
+                    continue
+                scanline[:] = a[1:]
+                recon = undo_filter(a[0], scanline, recon)
                 yield recon
+                scanline, spare = spare, scanline
+                del a[:]
+            # Rows that lie entirely within this block are
+            # copied straight out of it into the row buffer,
+            # without going through the accumulator.
+            end = len(view) - rb
+            while offset < end:
+                filter_type = view[offset]
+                if filter_type == 0:
+                    # Nothing to undo,
+                    # so the row is a view into the block, not a copy.
+                    recon = view[offset + 1: offset + stride]
+                    offset += stride
+                    yield recon
+                    continue
+                scanline[:] = view[offset + 1: offset + stride]
+                offset += stride
+                recon = undo_filter(filter_type, scanline, recon)
+                yield recon
+                scanline, spare = spare, scanline
+            a.extend(view[offset:])
         if len(a) != 0:
             # :file:format We get here with a file format error:
             # when the available bytes (after decompressing) do not
@@ -1642,6 +1714,35 @@ class Reader:
                 return
             self.process_chunk(lenient=lenient)
 
+    def dimensions(self, lenient=False):
+        """
+        Return the (*width*, *height*, *bitdepth*, *color_type*)
+        of the image, reading only as far as the ``IHDR`` chunk.
+
+        This is cheaper than :meth:`preamble`
+        (and much cheaper than :meth:`read`)
+        for callers that only need the image size;
+        no other chunks are read and no image data is decompressed.
+        Other methods, such as :meth:`read`,
+        can still be called afterwards.
+
+        If the optional `lenient` argument evaluates to `True`,
+        checksum failures will raise warnings rather than exceptions.
+        """
+
+        self.validate_signature()
+
+        if not hasattr(self, 'width'):
+            if not self.atchunk:
+                self.atchunk = self._chunk_len_type()
+                if self.atchunk is None:
+                    raise FormatError('This PNG file has no IHDR chunk.')
+            # http://www.w3.org/TR/PNG/#5ChunkOrdering
+            if self.atchunk[1] != b'IHDR':
+                raise FormatError('IHDR chunk is not the first chunk.')
+            self.process_chunk(lenient=lenient)
+        return self.width, self.height, self.bitdepth, self.color_type
+
     def _chunk_len_type(self):
         """
         Reads just enough of the input to
@@ -1726,7 +1827,9 @@ class Reader:
         self.psize = float(self.bitdepth) / float(8) * planes
         if int(self.psize) == self.psize:
             self.psize = int(self.psize)
-        self.row_bytes = int(math.ceil(self.width * self.psize))
+        # Row size in bytes, rounded up to a whole byte
+        # (using integer arithmetic, not the float psize).
+        self.row_bytes = (self.width * self.bitdepth * planes + 7) // 8
         # Stores PLTE chunk if present, and is used to check
         # chunk ordering constraints.
         self.plte = None
@@ -1741,13 +1844,14 @@ class Reader:
         if self.plte:
             warnings.warn("Multiple PLTE chunks present.")
         self.plte = data
-        if len(data) % 3 != 0:
+        n = len(data)
+        if n == 0:
+            raise FormatError("Empty PLTE is not allowed.")
+        if n % 3 != 0:
             raise FormatError(
                 "PLTE chunk's length should be a multiple of 3.")
-        if len(data) > (2 ** self.bitdepth) * 3:
+        if n > 3 << self.bitdepth:
             raise FormatError("PLTE chunk is too long.")
-        if len(data) == 0:
-            raise FormatError("Empty PLTE is not allowed.")
 
     def _process_bKGD(self, data):
         try:
@@ -1757,8 +1861,8 @@ class Reader:
                         "PLTE chunk is required before bKGD chunk.")
                 self.background = struct.unpack('B', data)
             else:
-                self.background = struct.unpack("!%dH" % self.color_planes,
-                                                data)
+                self.background = colour_struct[self.color_planes].unpack(
+                    data)
         except struct.error:
             raise FormatError("bKGD chunk has incorrect length.")
 
@@ -1780,7 +1884,7 @@ class Reader:
                     self.color_type)
             try:
                 self.transparent = \
-                    struct.unpack("!%dH" % self.color_planes, data)
+                    colour_struct[self.color_planes].unpack(data)
             except struct.error:
                 raise FormatError("tRNS chunk has incorrect length.")
 
@@ -1822,17 +1926,19 @@ class Reader:
 
         def iteridat():
             """Iterator that yields all the ``IDAT`` chunks as strings."""
+            # The preamble has already been read (up to the first
+            # IDAT chunk), so the PLTE check only needs doing once.
+            # http://www.w3.org/TR/PNG/#11IDAT
+            if self.colormap and not self.plte:
+                warnings.warn("PLTE chunk is required before IDAT chunk")
+            chunk = self.chunk
             while True:
-                type, data = self.chunk(lenient=lenient)
+                type, data = chunk(lenient=lenient)
                 if type == b'IEND':
                     # http://www.w3.org/TR/PNG/#11IEND
                     break
                 if type != b'IDAT':
                     continue
-                # type == b'IDAT'
-                # http://www.w3.org/TR/PNG/#11IDAT
-                if self.colormap and not self.plte:
-                    warnings.warn("PLTE chunk is required before IDAT chunk")
                 yield data
 
         self.preamble(lenient=lenient)
@@ -1843,7 +1949,9 @@ class Reader:
                 """Yield each row from an interlaced PNG."""
                 # It's important that this iterator doesn't read
                 # IDAT chunks until it yields the first row.
-                bs = bytearray(itertools.chain(*raw))
+                # A fresh, mutable, buffer is needed,
+                # because filters are undone in place.
+                bs = bytearray().join(raw)
                 arraycode = 'BH'[self.bitdepth > 8]
                 # Like :meth:`group` but
                 # producing an array.array object for each row.
@@ -1909,12 +2017,13 @@ class Reader:
         if not self.plte:
             raise FormatError(
                 "Required PLTE chunk is missing in colour type 3 image.")
-        plte = group(array('B', self.plte), 3)
+        p = self.plte
         if self.trns or alpha == 'force':
-            trns = array('B', self.trns or [])
-            trns.extend([255] * (len(plte) - len(trns)))
-            plte = list(map(operator.add, plte, group(trns, 1)))
-        return plte
+            trns = bytes(self.trns or b'')
+            # Entries with no tRNS value are opaque.
+            trns += b'\xff' * (len(p) // 3 - len(trns))
+            return list(zip(p[0::3], p[1::3], p[2::3], trns))
+        return list(zip(p[0::3], p[1::3], p[2::3]))
 
     def asDirect(self):
         """
@@ -1974,12 +2083,13 @@ class Reader:
             info['alpha'] = bool(self.trns)
             info['bitdepth'] = 8
             info['planes'] = 3 + bool(self.trns)
-            plte = self.palette()
+            # Each palette entry as bytes, so that a row can be
+            # expanded with a single join.
+            plte = [bytes(entry) for entry in self.palette()]
 
             def iterpal(pixels):
                 for row in pixels:
-                    row = [plte[x] for x in row]
-                    yield array('B', itertools.chain(*row))
+                    yield array('B', b''.join(map(plte.__getitem__, row)))
             pixels = iterpal(pixels)
         elif self.trns:
             # It would be nice if there was some reasonable way
@@ -2013,7 +2123,7 @@ class Reader:
             pixels = itertrns(pixels)
         targetbitdepth = None
         if self.sbit:
-            sbit = struct.unpack('%dB' % len(self.sbit), self.sbit)
+            sbit = tuple(self.sbit)
             targetbitdepth = max(sbit)
             if targetbitdepth > info['bitdepth']:
                 raise Error('sBIT chunk %r exceeds bitdepth %d' %
@@ -2042,8 +2152,20 @@ class Reader:
         def iterscale():
             for row in pixels:
                 yield [int(round(x * factor)) for x in row]
+
+        def iterscale_table():
+            # Source and target values both fit in a byte,
+            # so each row is rescaled by a single translate.
+            table = bytes(int(round(x * factor))
+                          for x in range(maxval + 1))
+            table = table.ljust(256, b'\x00')
+            for row in pixels:
+                yield bytearray(row).translate(table)
+
         if maxval == targetmaxval:
             return width, height, pixels, info
+        elif maxval <= 0xff and targetmaxval <= 0xff:
+            return width, height, iterscale_table(), info
         else:
             return width, height, iterscale(), info
 
@@ -2082,7 +2204,7 @@ class Reader:
 
         return self._as_rescale(self.asRGBA, 8)
 
-    def asRGB(self):
+    def asRGB(self, reuse_buffer=False):
         """
         Return image as RGB pixels.
         RGB colour images are passed through unchanged;
@@ -2095,6 +2217,13 @@ class Reader:
         the *info* reflect the returned pixels, not the source image.
         In particular,
         for this method ``info['greyscale']`` will be ``False``.
+
+        If the optional `reuse_buffer` argument evaluates to `True`,
+        then when greyscales are expanded
+        the same row object is yielded each time,
+        overwritten with the values for the next row.
+        This saves allocating a row for every row of the image,
+        but the caller must copy any row that it wants to keep.
         """
 
         width, height, pixels, info = self.asDirect()
@@ -2113,14 +2242,17 @@ class Reader:
                 return bytearray([0])
 
         def iterrgb():
-            for row in pixels:
+            if reuse_buffer:
                 a = newarray() * 3 * width
+            for row in pixels:
+                if not reuse_buffer:
+                    a = newarray() * 3 * width
                 for i in range(3):
                     a[i::3] = row
                 yield a
         return width, height, iterrgb(), info
 
-    def asRGBA(self):
+    def asRGBA(self, reuse_buffer=False):
         """
         Return image as RGBA pixels.
         Greyscales are expanded into RGB triplets;
@@ -2130,6 +2262,8 @@ class Reader:
         In particular, for this method
         ``info['greyscale']`` will be ``False``, and
         ``info['alpha']`` will be ``True``.
+
+        The optional `reuse_buffer` argument is as for :meth:`asRGB`.
         """
 
         width, height, pixels, info = self.asDirect()
@@ -2148,30 +2282,29 @@ class Reader:
 
         if info['alpha'] and info['greyscale']:
             # LA to RGBA
-            def convert():
-                for row in pixels:
-                    # Create a fresh target row, then copy L channel
-                    # into first three target channels, and A channel
-                    # into fourth channel.
-                    a = newarray()
-                    convert_la_to_rgba(row, a)
-                    yield a
+            # Copy L channel into first three target channels,
+            # and A channel into fourth channel.
+            convert_row = convert_la_to_rgba
         elif info['greyscale']:
             # L to RGBA
-            def convert():
-                for row in pixels:
-                    a = newarray()
-                    convert_l_to_rgba(row, a)
-                    yield a
+            convert_row = convert_l_to_rgba
         else:
             assert not info['alpha'] and not info['greyscale']
             # RGB to RGBA
-
-            def convert():
-                for row in pixels:
+            convert_row = convert_rgb_to_rgba
+
+        def convert():
+            # The target row starts with every value at maxval,
+            # and converting a row never changes a synthesized
+            # alpha channel, so a single row can be reused.
+            if reuse_buffer:
+                a = newarray()
+            for row in pixels:
+                if not reuse_buffer:
+                    # Create a fresh target row.
                     a = newarray()
-                    convert_rgb_to_rgba(row, a)
-                    yield a
+                convert_row(row, a)
+                yield a
         info['alpha'] = True
         info['greyscale'] = False
         info['planes'] = 4
@@ -2182,7 +2315,8 @@ def decompress(data_blocks):
     """
     `data_blocks` should be an iterable that
     yields the compressed data (from the ``IDAT`` chunks).
-    This yields decompressed byte strings.
+    This yields decompressed byte strings
+    (``bytes`` instances, straight from the decompressor, not copied).
     """
 
     # Currently, with no max_length parameter to decompress,
@@ -2193,8 +2327,8 @@ def decompress(data_blocks):
     # remaining state is decompressed out.
     for data in data_blocks:
         # :todo: add a max_length argument here to limit output size.
-        yield bytearray(d.decompress(data))
-    yield bytearray(d.flush())
+        yield d.decompress(data)
+    yield d.flush()
 
 
 def check_bitdepth_colortype(bitdepth, colortype):
@@ -2237,71 +2371,117 @@ def is_natural(x):
 def undo_filter_sub(filter_unit, scanline, previous, result):
     """Undo sub filter."""
 
-    ai = 0
-    # Loops starts at index fu.  Observe that the initial part
-    # of the result is already filled in correctly with
-    # scanline.
-    for i in range(filter_unit, len(result)):
-        x = scanline[i]
-        a = result[ai]
-        result[i] = (x + a) & 0xff
-        ai += 1
+    # Undoing the sub filter is a running sum (modulo 256) along
+    # each of the `filter_unit` interleaved streams of bytes.
+    # Rather than a Python loop over each byte,
+    # the bytes are spread out into the lanes of a single large
+    # integer, and the running sum is computed with
+    # log2(len(result)) shift-and-add steps over the whole row.
+    n = len(result)
+    # Size of each lane, in bytes.
+    # Lanes are wide enough that the sum of an entire row
+    # cannot carry into the next lane.
+    lane = 1 + (n.bit_length() + 7) // 8
+    size = n * lane
+    spread = bytearray(size)
+    spread[0::lane] = scanline
+    x = int.from_bytes(spread, 'little')
+    shift = 8 * lane * filter_unit
+    span = filter_unit
+    while span < n:
+        x += x << shift
+        shift <<= 1
+        span <<= 1
+    x &= (1 << (8 * size)) - 1
+    memoryview(result)[:] = x.to_bytes(size, 'little')[0::lane]
 
 
 def undo_filter_up(filter_unit, scanline, previous, result):
     """Undo up filter."""
 
-    for i in range(len(result)):
-        x = scanline[i]
-        b = previous[i]
-        result[i] = (x + b) & 0xff
+    # Each byte is independent, so the whole row is added at once
+    # using a single large integer for each of the
+    # scanline and previous line.
+    # The top bit of each byte is added separately (with xor)
+    # so that no carry crosses from one byte into the next.
+    n = len(result)
+    x = int.from_bytes(scanline, 'little')
+    b = int.from_bytes(previous, 'little')
+    low7 = int.from_bytes(b'\x7f' * n, 'little')
+    top = int.from_bytes(b'\x80' * n, 'little')
+    x = ((x & low7) + (b & low7)) ^ ((x ^ b) & top)
+    memoryview(result)[:] = x.to_bytes(n, 'little')
 
 
 def undo_filter_average(filter_unit, scanline, previous, result):
-    """Undo up filter."""
-
-    ai = -filter_unit
-    for i in range(len(result)):
-        x = scanline[i]
-        if ai < 0:
-            a = 0
-        else:
-            a = result[ai]
-        b = previous[i]
-        result[i] = (x + ((a + b) >> 1)) & 0xff
-        ai += 1
+    """Undo average filter."""
+
+    # Each of the `filter_unit` interleaved streams of bytes
+    # only depends on itself, so each is undone in turn.
+    # Iterating over the streams with zip, and carrying
+    # the left byte `a` in a local, avoids indexing and
+    # avoids testing for the start of the row on every byte.
+    for k in range(filter_unit):
+        # The byte to the left of the first byte is 0.
+        a = 0
+        out = bytearray()
+        append = out.append
+        for x, b in zip(scanline[k::filter_unit],
+                        previous[k::filter_unit]):
+            a = (x + ((a + b) >> 1)) & 0xff
+            append(a)
+        memoryview(result)[k::filter_unit] = out
 
 
 def undo_filter_paeth(filter_unit, scanline, previous, result):
     """Undo Paeth filter."""
 
-    # Also used for ci.
-    ai = -filter_unit
-    for i in range(len(result)):
-        x = scanline[i]
-        if ai < 0:
-            a = c = 0
-        else:
-            a = result[ai]
-            c = previous[ai]
-        b = previous[i]
-        p = a + b - c
-        pa = abs(p - a)
-        pb = abs(p - b)
-        pc = abs(p - c)
-        if pa <= pb and pa <= pc:
-            pr = a
-        elif pb <= pc:
-            pr = b
-        else:
-            pr = c
-        result[i] = (x + pr) & 0xff
-        ai += 1
+    # As for the average filter, each interleaved stream of bytes
+    # is undone in turn.
+    # `a` (left) and `c` (upper left) are carried from one byte to
+    # the next, and start at 0 at the beginning of the row,
+    # so there is no test for the start of the row in the loop.
+    for k in range(filter_unit):
+        a = c = 0
+        out = bytearray()
+        append = out.append
+        for x, b in zip(scanline[k::filter_unit],
+                        previous[k::filter_unit]):
+            # The Paeth estimate is p = a + b - c, and
+            # we need its distance from each of a, b, c;
+            # p - a is b - c, and so on.
+            pa = abs(b - c)
+            pb = abs(a - c)
+            pc = abs(a + b - c - c)
+            if pa <= pb and pa <= pc:
+                pr = a
+            elif pb <= pc:
+                pr = b
+            else:
+                pr = c
+            a = (x + pr) & 0xff
+            append(a)
+            c = b
+        memoryview(result)[k::filter_unit] = out
+
+
+# The functions that undo each filter type, indexed by filter type.
+# Filter type 0 (none) needs no function.
+undo_filters = (None,
+                undo_filter_sub,
+                undo_filter_up,
+                undo_filter_average,
+                undo_filter_paeth)
 
 
 def convert_la_to_rgba(row, result):
+    """
+    Convert a greyscale--alpha image to RGBA.
+    """
+    # Slice the L channel once, and copy it three times.
+    grey = row[0::2]
     for i in range(3):
-        result[i::4] = row[0::2]
+        result[i::4] = grey
     result[3::4] = row[1::2]
 
 